@@ -1,9 +1,11 @@
 import math
 import time
 import logging
-import csv
+from concurrent.futures import ThreadPoolExecutor
 
 
+import numpy as np
+
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
@@ -12,69 +14,63 @@ from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.crazyflie.log import LogConfig
 from cflib.utils.reset_estimator import reset_estimator
 
+logger = logging.getLogger(__name__)
+
 # URI to the Crazyflie to connect to
 uri = uri_helper.uri_from_env(default='radio://0/5/2M/EE5C21CF04')
 
-# Parmeters set in loggin function
-initial_position = [0,0,0]
+# Rotations applied to the x, y of a sequence
+ROTATE_CLOCKWISE = np.array([[0, 1], [-1, 0]])
+ROTATE_COUNTERCLOCKWISE = np.array([[0, -1], [1, 0]])
+
+# Grid cells per metre along x and y, with y flipped to match the Crazyflie frame
+GRID_SCALE = np.array([10, -10])
+
+# Fastest the Crazyflie should move between waypoints, in m/s
+MAX_SPEED = 1.0
+# go_to plans each move as a 7th degree polynomial, which peaks at about 2.19x its average speed
+GO_TO_PEAK_RATIO = 2.19
+# Shortest time given to any move between waypoints, in seconds
+MIN_DURATION = 1.0
+
+def transform_sequence(sequence, matrix):
+    # Apply a 2x2 transform to the x, y of every position, leaving z untouched
+    positions = np.array(sequence, dtype=np.float32).reshape(len(sequence), 3)
+    positions[:, :2] = positions[:, :2] @ matrix.T
+    return positions
 
 def rotate_clock(sequence):
-    rotated_sequence = []
-    for pos in sequence:
-        x = pos[0]
-        y = pos[1]
-        z = pos[2]
-        new_x = y
-        new_y = -x
-        rotated_sequence.append((new_x, new_y, z))
-    return rotated_sequence
+    return transform_sequence(sequence, ROTATE_CLOCKWISE)
 
 def rotate_counterclock(sequence):
-    rotated_sequence = []
-    for pos in sequence:
-        x = pos[0]
-        y = pos[1]
-        z = pos[2]
-        new_x = -y
-        new_y = x
-        rotated_sequence.append((new_x, new_y, z))
-    return rotated_sequence
+    return transform_sequence(sequence, ROTATE_COUNTERCLOCKWISE)
 
 def read_path_waypoints(csv_file='path.csv'):
-    points = []
     try:
-        with open(csv_file, 'r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if len(row) >= 2:
-                    x, y = float(row[0]), float(row[1])
-                    points.append([x, y])
+        waypoints = parse_path_waypoints(csv_file)
     except FileNotFoundError:
-        print(f"CSV file {csv_file} not found")
-        return []
-    
-    if len(points) < 2:
-        return points
-    
-    waypoints = [points[0]]
-    
-    for i in range(1, len(points) - 1):
-        prev_dir = [points[i][0] - points[i-1][0], points[i][1] - points[i-1][1]]
-        next_dir = [points[i+1][0] - points[i][0], points[i+1][1] - points[i][1]]
-        
-        if prev_dir != next_dir:
-            waypoints.append(points[i])
-    
-    waypoints.append(points[-1])
-
-    if waypoints:
-        offset_x, offset_y = waypoints[0][0], waypoints[0][1]
-        normalized_waypoints = []
-        for point in waypoints:
-            # Convert to tuples with height 0.4
-            normalized_waypoints.append(((point[0] - offset_x)/10, -(point[1] - offset_y)/10, 0.4))
-        return normalized_waypoints
-    
+        logger.error('CSV file %s not found', csv_file)
+        return np.empty((0, 3), dtype=np.float32)
+
+    # Build the (N, 3) sequence with height 0.4
+    sequence = np.empty((len(waypoints), 3), dtype=np.float32)
+    sequence[:, :2] = waypoints
+    sequence[:, 2] = 0.4
+    return sequence
+
+def parse_path_waypoints(csv_file):
+    points = np.loadtxt(csv_file, delimiter=',', usecols=(0, 1), ndmin=2)
+
+    # Keep the end points and every point where the direction of travel changes
+    directions = np.diff(points, axis=0)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:-1] = np.any(directions[1:] != directions[:-1], axis=1)
+    waypoints = points[keep]
+
+    # Normalise relative to the first waypoint, in metres with y flipped, in place on the
+    # copy made by the selection above
+    waypoints -= points[:1]
+    waypoints /= GRID_SCALE
     return waypoints
 
 def set_initial_position(scf, x, y, z, yaw_deg):
@@ -88,25 +84,41 @@ def set_initial_position(scf, x, y, z, yaw_deg):
 
 def run_sequence(scf, sequence, base_x, base_y, base_z, yaw):
     cf = scf.cf
+    commander = cf.high_level_commander
+
+    if len(sequence) == 0:
+        return
+
+    # Offset every waypoint by the starting position in one go
+    setpoints = np.asarray(sequence, dtype=float) + np.array([base_x, base_y, base_z], dtype=float)
+
+    # Time each move from its length so the peak speed stays under MAX_SPEED, starting from
+    # the point straight above the base that takeoff climbs to
+    previous = np.vstack(([base_x, base_y, setpoints[0, 2]], setpoints[:-1]))
+    distances = np.linalg.norm(setpoints - previous, axis=1)
+    durations = np.maximum(distances * GO_TO_PEAK_RATIO / MAX_SPEED, MIN_DURATION)
+
+    yaw_radians = math.radians(yaw)
 
     # Arm the Crazyflie
     cf.platform.send_arming_request(True)
     time.sleep(1.0)
 
-    for position in sequence:
-        print('Setting position {}'.format(position))
-
-        x = position[0] + base_x
-        y = position[1] + base_y
-        z = position[2] + base_z
+    # go_to is ignored by the firmware until the Crazyflie has taken off
+    commander.takeoff(setpoints[0, 2], 2.0, yaw=yaw_radians)
+    time.sleep(2.0)
 
-        for i in range(15):
-            cf.commander.send_position_setpoint(x, y, z, yaw)
-            time.sleep(0.1)
+    # Schedule waypoints against the monotonic clock so time spent sending doesn't accumulate
+    next_waypoint = time.monotonic()
+    for position, (x, y, z), duration in zip(sequence, setpoints.tolist(), durations.tolist()):
+        logger.info('Setting position %s', position)
+        commander.go_to(x, y, z, yaw_radians, duration)
+        next_waypoint += duration
+        time.sleep(max(0.0, next_waypoint - time.monotonic()))
 
-    cf.commander.send_stop_setpoint()
-    # Hand control over to the high level commander to avoid timeout and locking of the Crazyflie
-    cf.commander.send_notify_setpoint_stop()
+    commander.land(base_z, 2.0, yaw=yaw_radians)
+    time.sleep(2.0)
+    commander.stop()
 
     # Make sure that the last packet leaves before the link is closed
     # since the message queue is not flushed before closing
@@ -114,22 +126,28 @@ def run_sequence(scf, sequence, base_x, base_y, base_z, yaw):
 
 def log_initial_pos(scf, logconf):
 
-    with SyncLogger(scf, logconf) as logger:
+    with SyncLogger(scf, logconf) as sync_logger:
 
-        for log_entry in logger:
+        for log_entry in sync_logger:
 
             timestamp = log_entry[0]
             data = log_entry[1]
             logconf_name = log_entry[2]
 
-            print('[%d][%s]: %s' % (timestamp, logconf_name, data))
-            initial_position[0] = data['stateEstimate.x']
-            initial_position[1] = data['stateEstimate.y']
-            initial_position[2] = data['stateEstimate.z']
-
-            break
+            logger.debug('[%d][%s]: %s', timestamp, logconf_name, data)
+            return np.array([data['stateEstimate.x'], data['stateEstimate.y'], data['stateEstimate.z']],
+                            dtype=np.float32)
 
 if __name__ == '__main__':
+    # Only show errors from cflib, but keep this script's progress messages
+    logging.basicConfig(level=logging.ERROR)
+    logger.setLevel(logging.INFO)
+
+    # Reading path.csv doesn't need the radio, so do it while the link comes up
+    executor = ThreadPoolExecutor(max_workers=1)
+    sequence_future = executor.submit(read_path_waypoints, 'path.csv')
+    executor.shutdown(wait=False)
+
     cflib.crtp.init_drivers()
 
     # Set these to the position and yaw based on how your Crazyflie is placed
@@ -141,14 +159,12 @@ if __name__ == '__main__':
     lg_stab.add_variable('stateEstimate.y', 'float')
     lg_stab.add_variable('stateEstimate.z', 'float')
 
+    # Use one connection for both reading the start position and flying, rather than reconnecting
     with SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache')) as scf:
-        log_initial_pos(scf, lg_stab)
-
+        initial_position = log_initial_pos(scf, lg_stab)
+        logger.info('Initial position: %s %s %s', *initial_position)
 
-    print("Initial position: ", initial_position[0], initial_position[1], initial_position[1])
-    with SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache')) as scf:
-        
         set_initial_position(scf, initial_position[0], initial_position[1], initial_position[2], initial_yaw)
         reset_estimator(scf)
-        sequence = read_path_waypoints('path.csv')
+        sequence = sequence_future.result()
         run_sequence(scf, sequence, initial_position[0], initial_position[1], initial_position[2], initial_yaw)